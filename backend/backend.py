@@ -46,8 +46,17 @@
 # To test, use curl with the sample.json file to request a firmware build:
 #   curl -X POST -H "content-type: application/json" localhost:5544/firmware -d "$(cat sample.json)"
 #
-#   -> returns a JSON response containing the hash, e.g.:
-#   {"hash": "2bae9b9d4e46f8bfd7cb93ff27a79e841d124c3d"}
+#   -> returns a JSON response containing the job id the build was queued as, e.g.:
+#   {"job_id": "f3769a48c0c446cf9bd43b1ea0b34a9c"}
+#
+#
+# Poll the job status until the build is done:
+#   curl -X GET -H "content-type: application/json" localhost:5544/firmware/job/f3769a48c0c446cf9bd43b1ea0b34a9c
+#
+#   -> returns {"status": "building"} while the build is running, and eventually
+#      either {"status": "done", "hash": "2bae9b9d4e46f8bfd7cb93ff27a79e841d124c3d"}
+#      or {"status": "failed", "error": "..."} - the hash is then used for any
+#      further requests regarding the firmware itself
 #
 #
 # Request additional information from the build:
@@ -61,12 +70,113 @@
 #   -> retrieves and writes ledmacher.bin (note the -OJ parameter for that to actually happen)
 #
 
+import concurrent.futures
+import fastjsonschema
 import hashlib
+import multiprocessing
 import os
-import json
+import orjson
 import bottle
 import subprocess
-import time
+import threading
+import uuid
+import waitress
+
+
+# When running behind nginx, set this to the internal location that aliases the
+# build directory, e.g. LEDMACHER_ACCEL_REDIRECT=/internal-build with
+#
+#   location /internal-build/ {
+#       internal;
+#       alias /path/to/backend/build/;
+#       sendfile on;
+#       tcp_nopush on;
+#   }
+#
+# Downloads are then handed off to nginx via X-Accel-Redirect and the kernel
+# sendfile()s the binary straight from the page cache, instead of pumping every
+# byte through Python. If unset, files are served by bottle itself as before.
+ACCEL_REDIRECT_BASE = os.environ.get('LEDMACHER_ACCEL_REDIRECT')
+
+# Builds run asynchronously in a pool of worker processes, so a POST request
+# returns right away with a job id instead of holding its server thread for
+# however long the compile takes. The pool size also caps how many toolchains
+# can run in parallel, no matter how many build requests come in at once.
+#
+# The workers are spawned fresh rather than forked: forking happens lazily on
+# the first submit, i.e. from a request thread once the server socket is open,
+# and forked workers inheriting that socket kept port 5544 bound (hello
+# EADDRINUSE on restart) whenever the server was killed without the executor's
+# atexit shutdown getting a chance to run.
+EXECUTOR = concurrent.futures.ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context('spawn'))
+
+# Maps job id -> Future of a submitted build, for the job status endpoint
+JOBS = {}
+
+# Maps payload hash -> Future of that configuration's build, finished or still
+# in flight. A POST of a configuration that's already building gets a job id
+# pointing at the existing Future, instead of racing a second toolchain run in
+# the very same build directory. Guarded by BUILDS_LOCK as the server threads
+# hit this concurrently.
+BUILDS = {}
+BUILDS_LOCK = threading.Lock()
+
+# Templates for the header content piped to the ./buildme.sh script, kept as
+# module-level bytes so each request neither re-parses the format string nor
+# runs a full encode() pass over the assembled payload
+HEADER_TEMPLATE = b"""
+#define NUM_LEDS %d
+
+#define WAIT_COLOR_MS %d
+#define WAIT_GRADIENT_MS %d
+#define GRADIENT_STEPS %d
+
+struct cRGB colors[] = {
+"""
+COLOR_TEMPLATE = b"    { .r = %3d, .g = %3d, .b = %3d },"
+FOOTER = b"\n};\n"
+
+# Validator for the posted configuration data, compiled once at import time.
+# Bad requests get rejected right here in microseconds, before any header
+# templating or - worse - a full toolchain run that's doomed to fail anyway.
+# Also finally puts a dent into the BIG FAT WARNING NOTE above, as garbage
+# input no longer makes it anywhere near the shell.
+VALIDATE_CONFIG = fastjsonschema.compile({
+    'type': 'object',
+    'required': ['num_leds', 'wait_color', 'wait_gradient', 'gradient_steps', 'colors'],
+    'properties': {
+        'num_leds': {'type': 'integer', 'minimum': 1, 'maximum': 1024},
+        'wait_color': {'type': 'integer', 'minimum': 0},
+        'wait_gradient': {'type': 'integer', 'minimum': 0},
+        'gradient_steps': {'type': 'integer', 'minimum': 1},
+        'colors': {
+            'type': 'array',
+            'minItems': 1,
+            'maxItems': 1024,
+            'items': {
+                'type': 'object',
+                'required': ['r', 'g', 'b'],
+                'properties': {
+                    'r': {'type': 'integer', 'minimum': 0, 'maximum': 255},
+                    'g': {'type': 'integer', 'minimum': 0, 'maximum': 255},
+                    'b': {'type': 'integer', 'minimum': 0, 'maximum': 255},
+                },
+            },
+        },
+    },
+})
+
+
+def json_response(data):
+    """
+    Return the given data serialized by orjson as JSON response.
+
+    Serializing ourselves instead of handing bottle a dict keeps the whole
+    JSON path in orjson's C code rather than the stdlib json module.
+    """
+    return bottle.HTTPResponse(body=orjson.dumps(data), content_type='application/json')
 
 
 @bottle.route('/')
@@ -74,45 +184,75 @@ def index():
     return "It works!"
 
 
-@bottle.post('/firmware')
-def build_firmware():
+def sha1_file(filepath):
     """
-    Request a firmware build.
+    Calculate the SHA1 checksum of the given file.
 
-    The configuration data is expected as JSON data within the POST request and used to create
-    header file information for the ./buildme.sh script.
+    The file is hashed in fixed-size chunks instead of reading it into memory
+    as a whole, so this stays at constant memory use no matter how big the
+    firmware binary might grow one day.
+    """
+    with open(filepath, 'rb') as binfile:
+        try:
+            # Python 3.11+ hashes the file in a C-level loop, use that if available
+            return hashlib.file_digest(binfile, 'sha1').hexdigest()
+        except AttributeError:
+            sha1 = hashlib.sha1()
+            for chunk in iter(lambda: binfile.read(1 << 20), b''):
+                sha1.update(chunk)
+            return sha1.hexdigest()
+
+
+def write_firmware_meta(build_dir):
+    """
+    Collect size, create time, and SHA1 checksum of a build's ledmacher.bin
+    file and persist them as meta.json next to it.
 
-    If the build succeeds, the hash returned from the ./buildme.sh script is sent as JSON data
-    back to the caller, to be used for any future requests regarding the firmware itself.
+    The binary never changes once it's built, so all this only ever needs to
+    be figured out once - every later info request can then simply read the
+    meta.json file back instead of rehashing the whole binary each time.
 
-    If anything failed along the build, a 500 reponse is sent instead.
+    Returns the collected information as dict.
     """
+    firmware_file = '{}/ledmacher.bin'.format(build_dir)
+    meta_file = '{}/meta.json'.format(build_dir)
 
-    # Print and collect data about the request
-    print(bottle.request)
-    print(bottle.request.json)
-    json_data = bottle.request.json
-    client = bottle.request.environ.get('REMOTE_ADDR')
+    stat = os.stat(firmware_file)
+    meta_data = dict(
+            size=stat.st_size,
+            created=int(stat.st_ctime),
+            checksum=sha1_file(firmware_file))
+
+    with open(meta_file, 'wb') as outfile:
+        outfile.write(orjson.dumps(meta_data))
 
-    # Collect configuration to be sent to the ./buildme.sh script
-    out_data = """
-#define NUM_LEDS {num_leds:d}
+    return meta_data
 
-#define WAIT_COLOR_MS {wait_color:d}
-#define WAIT_GRADIENT_MS {wait_gradient:d}
-#define GRADIENT_STEPS {gradient_steps:d}
 
-""".format(**json_data)
+def run_build(out_data, json_data, client, payload_hash):
+    """
+    Run the actual firmware build by calling the ./buildme.sh script.
+
+    The payload hash (SHA1 of the canonicalized config JSON) is passed on to the
+    script to use as build hash, so identical configurations map to the same
+    build directory and can be reused instead of compiled all over again.
 
-    # Add color definitions to the config data
-    out_data += "struct cRGB colors[] = {\n"
-    for c in json_data['colors']:
-        out_data += "    {{ .r = {r:3}, .g = {g:3}, .b = {b:3} }},\n".format(**c)
-    out_data += "};\n"
+    This is what the executor's worker processes run, so no bottle in here -
+    failures are raised as RuntimeError and turn up as the job's exception.
+
+    Returns the firmware hash the ./buildme.sh script wrote out.
+    """
 
-    # Call the script, opening up pipes for input and output to pass config data and get the hash back
-    process = subprocess.Popen(['./buildme.sh', client], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    out, err = process.communicate(out_data.encode('utf-8'))
+    # Call the script, opening up pipes for input and output to pass config data and get the hash back.
+    # Buffered pipes (bufsize=-1 instead of the unbuffered default) coalesce the script's output into
+    # fewer syscalls, and a bigger kernel pipe buffer keeps a chatty build from blocking on writes.
+    popen_args = dict(stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=-1)
+    try:
+        process = subprocess.Popen(['./buildme.sh', client, payload_hash], pipesize=1 << 20, **popen_args)
+    except TypeError:
+        # pipesize needs Python 3.10+, just go with the kernel's default size before that
+        process = subprocess.Popen(['./buildme.sh', client, payload_hash], **popen_args)
+    out, err = process.communicate(out_data)
     returncode = process.returncode;
     firmware_hash = out.decode('utf-8')
 
@@ -122,21 +262,130 @@ def build_firmware():
     # If for whatever reason there's no hash written from the ./buildme.sh script, abort
     if firmware_hash is None or firmware_hash == "":
         # TODO dump the retrieved JSON data and build output to a log file, just in case
-        bottle.abort(500, "Yeah, this didn't work")
-    
+        raise RuntimeError("Yeah, this didn't work")
+
     # Write the original content as config.json file to the build directory
     build_dir = './build/{}'.format(firmware_hash)
     json_file = '{}/config.json'.format(build_dir)
     if os.path.isdir(build_dir):
-        with open(json_file, 'w') as outfile:
-            json.dump(json_data, outfile)
+        with open(json_file, 'wb') as outfile:
+            outfile.write(orjson.dumps(json_data))
+        # Collect the binary's details once here, so info requests won't have to
+        if returncode == 0:
+            write_firmware_meta(build_dir)
 
     # If all went well, return the hash, otherwise, don't
     if returncode == 0:
-        time.sleep(1)
-        return dict(hash=firmware_hash)
+        return firmware_hash
     else:
-        bottle.abort(500, "Build failed")
+        raise RuntimeError("Build failed")
+
+
+@bottle.post('/firmware')
+def build_firmware():
+    """
+    Request a firmware build.
+
+    The configuration data is expected as JSON data within the POST request and used to create
+    header file information for the ./buildme.sh script.
+
+    The build itself is handed off to the worker process pool and the id it's queued up as is
+    sent as JSON data back to the caller, to poll the build status via the job status endpoint.
+
+    If the configuration data isn't valid JSON or doesn't match the expected schema,
+    a 400 response is sent right away instead.
+    """
+
+    # Print and collect data about the request, parsing the raw body with orjson
+    # directly rather than going through bottle's stdlib-json based .json property
+    print(bottle.request)
+    try:
+        json_data = orjson.loads(bottle.request.body.read())
+        VALIDATE_CONFIG(json_data)
+    except (orjson.JSONDecodeError, fastjsonschema.JsonSchemaException) as error:
+        bottle.abort(400, "Bad config data: {}".format(error))
+    print(json_data)
+    client = bottle.request.environ.get('REMOTE_ADDR')
+
+    # Identical configurations produce identical firmware, so builds are keyed by
+    # the SHA1 of the key-sorted config JSON itself. If that configuration was
+    # already built - or is being built right now - the existing Future is handed
+    # out instead of running the whole toolchain again for the same binary.
+    canon = orjson.dumps(json_data, option=orjson.OPT_SORT_KEYS)
+    payload_hash = hashlib.sha1(canon).hexdigest()
+
+    submitted = False
+    with BUILDS_LOCK:
+        job = BUILDS.get(payload_hash)
+
+        if job is None and os.path.isfile('./build/{}/ledmacher.bin'.format(payload_hash)):
+            # Build exists on disk from an earlier run of the backend, register
+            # it as an already-completed job
+            job = concurrent.futures.Future()
+            job.set_result(payload_hash)
+            BUILDS[payload_hash] = job
+
+        if job is None:
+            # First time this configuration shows up, so off to an actual build.
+            #
+            # Collect configuration to be sent to the ./buildme.sh script, assembled
+            # straight as bytes from the module-level templates - the payload can then
+            # go down the pipe as-is, no encoding step needed.
+            # The color definitions are built as a list and joined in one go, instead of
+            # growing one big buffer with += which copies the whole thing every round.
+            color_lines = [COLOR_TEMPLATE % (c['r'], c['g'], c['b']) for c in json_data['colors']]
+            out_data = b''.join([
+                HEADER_TEMPLATE % (json_data['num_leds'], json_data['wait_color'],
+                                   json_data['wait_gradient'], json_data['gradient_steps']),
+                b"\n".join(color_lines),
+                FOOTER,
+            ])
+
+            # Queue the build up in the worker pool
+            job = EXECUTOR.submit(run_build, out_data, json_data, client, payload_hash)
+            BUILDS[payload_hash] = job
+            submitted = True
+
+    if submitted:
+        # Drop failed builds from the map again so posting the same configuration
+        # later retries the build instead of serving the cached failure.
+        # Registered outside the lock - if the job finished already, the callback
+        # runs right here in this thread and would deadlock otherwise.
+        def forget_failed_build(finished_job):
+            if finished_job.exception() is not None:
+                with BUILDS_LOCK:
+                    BUILDS.pop(payload_hash, None)
+        job.add_done_callback(forget_failed_build)
+
+    job_id = uuid.uuid4().hex
+    JOBS[job_id] = job
+    return json_response(dict(job_id=job_id))
+
+
+@bottle.get('/firmware/job/<job_id>')
+def get_job_status(job_id):
+    """
+    Retrieve the status of a previously queued firmware build job.
+
+    While the build is still running, a "building" status is returned. Once it's through,
+    the status is either "done" along with the firmware hash to use for any further
+    requests, or "failed" along with whatever the build raised as error.
+
+    If the given job id doesn't exist, 404 response is sent.
+    """
+
+    job = JOBS.get(job_id)
+    if job is None:
+        bottle.abort(404, "No such job")
+
+    if not job.done():
+        return json_response(dict(status='building'))
+
+    error = job.exception()
+    if error is not None:
+        return json_response(dict(status='failed', error=str(error)))
+
+    return json_response(dict(status='done', hash=job.result()))
 
 
 @bottle.get('/firmware/<firmware_hash>')
@@ -153,24 +402,30 @@ def get_firmware_info(firmware_hash):
 
     build_dir = './build/{}'.format(firmware_hash)
     config_file = '{}/config.json'.format(build_dir)
-    firmware_file = '{}/ledmacher.bin'.format(build_dir)
-
-    if os.path.isfile(config_file):
-        with open(config_file) as json_file:
-            config_data = json.load(json_file)
-
-        created = int(os.path.getctime(config_file))
-        firmware_size = os.path.getsize(firmware_file)
-        firmware_checksum = hashlib.sha1(open(firmware_file, 'rb').read()).hexdigest()
-
-        return dict(
-                build_hash=firmware_hash,
-                date=created,
-                size=firmware_size,
-                checksum=firmware_checksum,
-                config=config_data)
-
-    return bottle.abort(404, "Firmware not found")
+    meta_file = '{}/meta.json'.format(build_dir)
+
+    # Just open the files right away instead of checking their existence first -
+    # that'd only add an extra stat() per file, plus a window for the file to
+    # vanish between the check and the open
+    try:
+        with open(config_file, 'rb') as json_file:
+            config_data = orjson.loads(json_file.read())
+    except FileNotFoundError:
+        bottle.abort(404, "Firmware not found")
+
+    try:
+        with open(meta_file, 'rb') as json_file:
+            meta_data = orjson.loads(json_file.read())
+    except FileNotFoundError:
+        # Build predates the meta.json sidecar, collect (and cache) its data now
+        meta_data = write_firmware_meta(build_dir)
+
+    return json_response(dict(
+            build_hash=firmware_hash,
+            date=meta_data['created'],
+            size=meta_data['size'],
+            checksum=meta_data['checksum'],
+            config=config_data))
 
 
 @bottle.get('/firmware/<firmware_hash>/bin')
@@ -187,19 +442,34 @@ def download_firmware(firmware_hash):
     filename = 'ledmacher.bin'
     filepath = './build/{}/{}'.format(firmware_hash, filename)
 
-    if os.path.isfile(filepath):
-        # download='' option defines via Content-disposition header what filename should be.
-        #  Chromium follows that
-        #  curl needs -OJ parameter (-O to define 'use remote name as output file' and -J to say 'follow that header')
-        #  wget needs --content-disposition header
-        time.sleep(1)
-        return bottle.static_file(filepath, root='./', mimetype='application/octet-stream', download=filename)
-
-    bottle.abort(404, "Nope")
+    # One stat() to see the file's there (instead of a separate isfile() check
+    # on top), and off it goes
+    try:
+        os.stat(filepath)
+    except FileNotFoundError:
+        bottle.abort(404, "Nope")
+
+    # download='' option defines via Content-disposition header what filename should be.
+    #  Chromium follows that
+    #  curl needs -OJ parameter (-O to define 'use remote name as output file' and -J to say 'follow that header')
+    #  wget needs --content-disposition header
+    if ACCEL_REDIRECT_BASE:
+        # Let nginx serve the actual bytes, see ACCEL_REDIRECT_BASE note above
+        bottle.response.headers['X-Accel-Redirect'] = '{}/{}/{}'.format(
+                ACCEL_REDIRECT_BASE, firmware_hash, filename)
+        bottle.response.headers['Content-Type'] = 'application/octet-stream'
+        bottle.response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+        return ''
+    return bottle.static_file(filepath, root='./', mimetype='application/octet-stream', download=filename)
 
 
 if __name__ == '__main__':
-    bottle.run(host='0.0.0.0', port=5544)
+    # Use waitress as server with a thread pool instead of bottle's default wsgiref,
+    # which handles only one request at a time - i.e. a running build would block
+    # every other info request and download until it's done.
+    # Called directly instead of via bottle.run(server='waitress'), as bottle 0.12's
+    # waitress adapter silently drops extra options like the thread count.
+    waitress.serve(bottle.default_app(), host='0.0.0.0', port=5544, threads=16)
 else:
     application = bottle.default_app()
     print("TODO: do something with this")
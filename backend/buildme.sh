@@ -38,9 +38,10 @@
 # file can be used for testing.
 #
 # An optional client string can be given (e.g. IP address) that is used
-# when creating the session hash. A later version could actually just
-# use the hash of the config data itself, allowing to re-use previous
-# builds for identical configurations (something to consider at least).
+# when creating the session hash. As second optional parameter, the build
+# hash itself can be given - the backend passes the hash of the config
+# data here, allowing to re-use previous builds for identical
+# configurations instead of compiling the same thing all over again.
 #
 # NOTE: As the Python script is reading back the output and expecting
 # the session hash, all communication to the user / shell itself *MUST*
@@ -49,7 +50,7 @@
 
 # Check that there's data coming straight from stdin, or abort if not
 if [ ! -p /dev/stdin ] ; then
-    >&2 echo "Usage: <generate some output> | $0 [<client string>]"
+    >&2 echo "Usage: <generate some output> | $0 [<client string>] [<build hash>]"
     exit 1
 fi
 
@@ -80,15 +81,36 @@ fi
 
 
 # Create session-specific build hash
-# The hash is just the SHA1 checksum of the given client ID and the current
-# time's string representation concatenated to "<client> <date string>"
+# If a hash is given as second parameter (normally the SHA1 checksum of the
+# config data itself, so identical configs end up as the same build), that
+# one is used as-is. Otherwise the hash is just the SHA1 checksum of the
+# given client ID and the current time's string representation concatenated
+# to "<client> <date string>"
 client="$1"
 now=$(date)
-build_hash=$(echo $client $now | sha1sum | cut -d\  -f 1)
+if [ -n "$2" ] ; then
+    build_hash="$2"
+else
+    build_hash=$(echo $client $now | sha1sum | cut -d\  -f 1)
+fi
+
+# If that exact build exists already, there's nothing left to do here
+if [ -f build/$build_hash/ledmacher.bin ] ; then
+    >&2 echo "Reusing existing build $build_hash"
+    echo -n $build_hash
+    exit 0
+fi
 
 # Create session-specific build directory simply named like the hash
 build_dir=build/$build_hash
 
+# Clean up leftovers from an earlier failed attempt - cp'ing into an
+# existing directory would nest the base directory inside it instead
+if [ -d $build_dir ] ; then
+    >&2 echo "Removing stale build directory $build_dir"
+    rm -rf $build_dir
+fi
+
 # Copy base directory to session-specific build directory
 >&2 echo "Creating $build_hash"
 cp -ar build/base $build_dir